@@ -24,12 +24,15 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import multiprocessing
 import os
 import re
 import sys
 import shutil
 import uuid
 
+from collections import OrderedDict
+
 try:
     import ConfigParser
 except ImportError:
@@ -56,6 +59,20 @@ except NameError:
     raw_input = input
 
 
+try:
+    _replace_file = os.replace
+except AttributeError:
+    # Python 2: os.rename is atomic on POSIX but refuses to overwrite an
+    # existing destination on Windows, where the target must be removed
+    # first (losing atomicity, but no worse than an in-place rewrite).
+    def _replace_file(src, dst):
+        try:
+            os.rename(src, dst)
+        except OSError:
+            os.remove(dst)
+            os.rename(src, dst)
+
+
 __version__ = '2.2'
 
 # Name of scspell.conf section header
@@ -75,26 +92,41 @@ SCSPELL_BUILTIN_DICT = os.path.join(SCSPELL_DATA_DIR, 'dictionary.txt')
 
 SCSPELL_CONF = os.path.join(USER_DATA_DIR, 'scspell.conf')
 
+# Pin \w to [A-Za-z0-9_].  Python 2 unicode patterns do this by default;
+# re.ASCII keeps Python 3 on the same fast byte-oriented path instead of
+# consulting the Unicode property tables for every character.
+try:
+    _RE_ASCII = re.ASCII
+except AttributeError:
+    # Python 2
+    _RE_ASCII = 0
+
 # Treat anything alphanumeric as a token of interest, as long as it is not
 # immediately preceded by a single backslash.  (The string "\ntext" should
 # match on "text" rather than "ntext".)
-C_ESCAPE_TOKEN_REGEX = re.compile(r'(?<![^\\]\\)\w+')
+C_ESCAPE_TOKEN_REGEX = re.compile(r'(?<![^\\]\\)\w+', _RE_ASCII)
 
 # \ is not a character escape in e.g. LaTeX
-TOKEN_REGEX = re.compile(r'\w+')
+TOKEN_REGEX = re.compile(r'\w+', _RE_ASCII)
 
 # Hex digits will be treated as a special case, because they can look like
 # word-like even though they are actually numeric
 HEX_REGEX = re.compile(r'0x[0-9a-fA-F]+')
 
 # We assume that tokens will be split using either underscores,
-# digits, or camelCase conventions (or both)
-US_REGEX = re.compile(r'[_\d]+')
-CAMEL_WORD_REGEX = re.compile(r'([A-Z][a-z]*)')
+# digits, or camelCase conventions (or both).  Underscores and digits
+# separate subtokens; a run of capitals is kept together as an acronym
+# unless its last letter begins a capitalized word (e.g. "VP9Codec"
+# yields "vp", "codec" and "HTTPServer" yields "http", "server").
+SUBTOKEN_REGEX = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+')
 
 # File-id specifiers take this form
 FILE_ID_REGEX = re.compile(r'scspell-id:[ \t]*([a-zA-Z0-9_\-]+)')
 
+# Compiled whole-token match regexes, keyed by token; the same misspelled
+# token tends to recur within a file and across a session.
+_match_regex_cache = {}
+
 
 class MatchDescriptor(object):
 
@@ -102,13 +134,18 @@ class MatchDescriptor(object):
     token matched within some source code."""
 
     def __init__(self, text, match_obj):
+        # Hold a reference to the (shared) source text plus the match
+        # indices; substrings are sliced out only on demand.
         self._data = text
         self._pos = match_obj.start()
-        self._token = match_obj.group()
+        self._end = match_obj.end()
+        self._token = None
         self._context = None
         self._line_num = None
 
     def get_token(self):
+        if self._token is None:
+            self._token = self._data[self._pos:self._end]
         return self._token
 
     def get_string(self):
@@ -134,48 +171,42 @@ class MatchDescriptor(object):
         if self._context is not None:
             return self._context
 
-        lines = self._data.split('\n')
-
-        # Compute the byte offset of start of every line
-        offsets = []
-        for i in range(len(lines)):
-            if i == 0:
-                offsets.append(0)
-            else:
-                offsets.append(offsets[i - 1] + len(lines[i - 1]) + 1)
+        data = self._data
+        line_num = self.get_line_num()
+        half = CONTEXT_SIZE // 2
 
-        # Compute the line number where the match is located
-        for (i, ofs) in enumerate(offsets):
-            if ofs > self._pos:
-                self._line_num = i
+        # Walk newline boundaries outward from the matched line rather
+        # than splitting the entire text
+        start = data.rfind('\n', 0, self._pos) + 1
+        first_line = line_num
+        for _ in range(half):
+            if start == 0:
                 break
-        if self._line_num is None:
-            self._line_num = len(lines)
+            start = data.rfind('\n', 0, start - 1) + 1
+            first_line -= 1
+        end = data.find('\n', self._pos)
+        for _ in range(half):
+            if end == -1:
+                break
+            end = data.find('\n', end + 1)
+        if end == -1:
+            end = len(data)
 
-        # Compute the set of lines surrounding this line number
         self._context = [
-            (i + 1, line.strip('\r\n'))for (i, line) in enumerate(lines)
-            if (i + 1 - self._line_num) in
-            range(-CONTEXT_SIZE // 2, CONTEXT_SIZE // 2 + 1)]
+            (first_line + i, line.rstrip('\r\n'))
+            for (i, line) in enumerate(data[start:end].split('\n'))]
         return self._context
 
     def get_line_num(self):
         """Computes the line number of the match."""
         if self._line_num is None:
-            self.get_context()
+            self._line_num = self._data.count('\n', 0, self._pos) + 1
         return self._line_num
 
 
 def make_unique(items):
     """Remove duplicate items from a list, while preserving list order."""
-    seen = set()
-
-    def first_occurrence(i):
-        if i not in seen:
-            seen.add(i)
-            return True
-        return False
-    return [i for i in items if first_occurrence(i)]
+    return list(OrderedDict.fromkeys(items))
 
 
 def get_new_file_id():
@@ -183,8 +214,15 @@ def get_new_file_id():
     return str(uuid.uuid1())
 
 
+# Decomposition is relatively expensive, and the same identifiers tend to
+# recur many times within a source tree, so memoize the results.  The cache
+# is cleared if it grows beyond this many distinct tokens.
+_DECOMPOSE_CACHE_MAX = 4096
+_decompose_cache = {}
+
+
 def decompose_token(token):
-    """Divide a token into a list of strings of letters.
+    """Divide a token into a tuple of strings of letters.
 
     Tokens are divided by underscores and digits, and capital letters will
     begin new subtokens.
@@ -193,17 +231,18 @@ def decompose_token(token):
     :returns: sequence of subtoken strings
 
     """
-    us_parts = US_REGEX.split(token)
-    if ''.join(us_parts).isupper():
-        # This looks like a CONSTANT_DEFINE_OF_SOME_SORT
-        subtokens = us_parts
-    else:
-        camelcase_parts = [
-            CAMEL_WORD_REGEX.split(
-                us_part) for us_part in us_parts]
-        subtokens = sum(camelcase_parts, [])
-    # This use of split() will create many empty strings
-    return [st.lower() for st in subtokens if st != '']
+    try:
+        return _decompose_cache[token]
+    except KeyError:
+        pass
+
+    result = tuple(
+        m.group().lower() for m in SUBTOKEN_REGEX.finditer(token))
+
+    if len(_decompose_cache) >= _DECOMPOSE_CACHE_MAX:
+        _decompose_cache.clear()
+    _decompose_cache[token] = result
+    return result
 
 
 def handle_new_filetype(extension, dicts):
@@ -384,7 +423,10 @@ def handle_failed_check_interactively(
     print("%s:%u: Unmatched '%s' --> {%s}" %
           (filename, match_desc.get_line_num(), token,
            ', '.join([st for st in unmatched_subtokens])))
-    MATCH_REGEX = re.compile(re.escape(match_desc.get_token()))
+    try:
+        match_regex = _match_regex_cache[token]
+    except KeyError:
+        match_regex = _match_regex_cache[token] = re.compile(re.escape(token))
     while True:
         print("""\
    (i)gnore, (I)gnore all, (r)eplace, (R)eplace all, (a)dd to dictionary, or
@@ -406,7 +448,7 @@ def handle_failed_check_interactively(
             else:
                 ignores.add(replacement.lower())
                 tail = re.sub(
-                    MATCH_REGEX, replacement, match_desc.get_remainder(),
+                    match_regex, replacement, match_desc.get_remainder(),
                     1 if ch == 'r' else 0)
                 print()
                 return (match_desc.get_prefix() + tail,
@@ -517,14 +559,30 @@ def spell_check_token(
 
     """
     token = match_desc.get_token()
-    if (token.lower() not in ignores) and (HEX_REGEX.match(token) is None):
+    tok_lower = token.lower()
+    # Only tokens beginning with "0x" can be hex literals; checking the
+    # prefix first keeps the regex engine off the hot path.
+    if (tok_lower not in ignores) and not (
+            token.startswith('0x') and HEX_REGEX.match(token)):
+        if (len(token) > LEN_THRESHOLD and
+                token.islower() and token.isalpha() and
+                dicts.match(token, filename, file_id_ref[0])):
+            # Fast path: a plain lowercase word decomposes to itself, so a
+            # whole-token dictionary hit needs no decomposition.
+            return (
+                (match_desc.get_string(),
+                 match_desc.get_ofs() + len(token)),
+                False)
         subtokens = decompose_token(token)
+        # decompose_token emits lowercased subtokens and ignores only ever
+        # holds lowercased entries, so the membership test below is already
+        # case-normalized.  Dedup up front so a repeated subtoken queries
+        # the dictionary once, and try the cheap checks before the lookup.
         unmatched_subtokens = [
-            st for st in subtokens if len(st) > LEN_THRESHOLD and
-            (not dicts.match(st, filename, file_id_ref[0])) and
-            (st not in ignores)]
+            st for st in make_unique(subtokens)
+            if len(st) > LEN_THRESHOLD and (st not in ignores) and
+            not dicts.match(st, filename, file_id_ref[0])]
         if unmatched_subtokens:
-            unmatched_subtokens = make_unique(unmatched_subtokens)
             if report_only:
                 function = getattr(
                     report_only, '__call__', report_failed_check)
@@ -580,36 +638,67 @@ def spell_check_file(filename, dicts, ignores, report_only, c_escapes):
     else:
         token_regex = TOKEN_REGEX
 
-    # Search for tokens to spell-check
+    # Search for tokens to spell-check.  A single finditer() pass covers
+    # the common case of unmodified text; the scan is only restarted
+    # (from just past the replacement) when an edit changes the text.
     data = source_text
     pos = 0
     okay = True
-    while True:
-        m = token_regex.search(data, pos)
-        if m is None:
-            break
-        if (m_id is not None and
-                m.start() >= m_id.start() and
-                m.start() < m_id.end()):
-            # This is matching the file-id.  Skip over it.
-            pos = m_id.end()
-            continue
-        result = spell_check_token(MatchDescriptor(data, m),
-                                   filename, fq_filename, file_id_ref,
-                                   dicts, ignores, report_only)
-        (data, pos) = result[0]
-        error_found = result[1]
-        if error_found:
-            okay = False
-
-    # Write out the source file if it was modified
-    if data != source_text:
-        with _util.open_with_encoding(fq_filename, mode='w') as source_file:
+    # Tokens which have already checked out clean in this file.  Session
+    # state only ever grows (words are added to dictionaries and to the
+    # ignore list, never removed), so a clean verdict stays valid and
+    # repeat occurrences can be skipped outright.
+    clean_tokens = set()
+    scanning = True
+    while scanning:
+        scanning = False
+        for m in token_regex.finditer(data, pos):
+            token = m.group()
+            if token in clean_tokens:
+                continue
+            if (m_id is not None and
+                    m.start() >= m_id.start() and
+                    m.start() < m_id.end()):
+                # This is matching the file-id.  Skip over it.
+                continue
+            result = spell_check_token(MatchDescriptor(data, m),
+                                       filename, fq_filename, file_id_ref,
+                                       dicts, ignores, report_only)
+            (new_data, pos) = result[0]
+            if result[1]:
+                okay = False
+            else:
+                clean_tokens.add(token)
+            if new_data is not data:
+                data = new_data
+                scanning = True
+                break
+
+    # Write out the source file if it was modified.  The scan loop only
+    # rebinds ``data`` when an edit occurs, so the identity test skips the
+    # full-text comparison for the (common) untouched case.  The new
+    # contents go to a temporary file which is renamed over the original,
+    # so a crash mid-write cannot leave a truncated source file behind.
+    if data is not source_text and data != source_text:
+        tmp_filename = fq_filename + '.scspell.tmp'
+        try:
+            with _util.open_with_encoding(
+                    tmp_filename,
+                    encoding=_util.detect_encoding(fq_filename),
+                    mode='w') as tmp_file:
+                tmp_file.write(data)
+            # Copy only the permission bits: the rename must not carry the
+            # original's timestamps, or the edit would be invisible to
+            # make, file watchers and editors.
+            shutil.copymode(fq_filename, tmp_filename)
+            _replace_file(tmp_filename, fq_filename)
+        except (IOError, OSError) as e:
+            print(str(e), file=sys.stderr)
             try:
-                source_file.write(data)
-            except IOError as e:
-                print(str(e), file=sys.stderr)
-                return False
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            return False
 
     return okay
 
@@ -622,13 +711,27 @@ def verify_user_data_dir():
         shutil.copyfile(SCSPELL_BUILTIN_DICT, DICT_DEFAULT_LOC)
 
 
+# Cached result of locate_dictionary(); parsing scspell.conf once per
+# process is enough.  set_dictionary() keeps the cache coherent.
+_dictionary_loc = None
+
+
 def locate_dictionary():
     """Load the location of the dictionary file.
 
     This is either the default location, or an override specified in
-    'scspell.conf'.
+    'scspell.conf'.  The result is cached for the life of the process.
 
     """
+    global _dictionary_loc
+    if _dictionary_loc is not None:
+        return _dictionary_loc
+    _dictionary_loc = _locate_dictionary()
+    return _dictionary_loc
+
+
+def _locate_dictionary():
+    """Determine the dictionary location from 'scspell.conf'."""
     verify_user_data_dir()
     try:
         f = _util.open_with_encoding(SCSPELL_CONF, encoding='utf-8')
@@ -662,6 +765,7 @@ def set_dictionary(filename):
     :returns: None
 
     """
+    global _dictionary_loc
     filename = os.path.realpath(
         os.path.expandvars(
             os.path.expanduser(
@@ -684,6 +788,7 @@ def set_dictionary(filename):
     with _util.open_with_encoding(SCSPELL_CONF, encoding='utf-8',
                                   mode='w') as f:
         config.write(f)
+    _dictionary_loc = filename
 
 
 def export_dictionary(filename, base_dicts):
@@ -708,6 +813,86 @@ def find_dict_file(override_dictionary):
     return os.path.expandvars(os.path.expanduser(dict_file))
 
 
+# Per-worker state for the parallel prescan, set up by _prescan_init()
+_prescan_state = None
+
+
+def _prescan_init(dict_file, base_dicts, relative_to, additional_extensions,
+                  c_escapes):
+    """Initialize a prescan worker with its own read-only dictionary set.
+
+    Workers never interact with the user, so their output is discarded.
+
+    """
+    global _prescan_state
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        dicts = CorporaFile(dict_file, base_dicts, relative_to)
+        for extension in (additional_extensions or []):
+            dicts.register_extension(*extension)
+    except BaseException:
+        # CorporaFile raises SystemExit on a malformed dictionary; letting
+        # that escape would kill the worker and make the pool respawn it
+        # endlessly.  Leave _prescan_state unset so every file is flagged
+        # suspect and the serial pass reports the failure.
+        return
+    _prescan_state = (dicts, c_escapes)
+
+
+def _prescan_report(match_desc, filename, unmatched_subtokens):
+    """Silently acknowledge a failed check during a prescan."""
+    return (match_desc.get_string(),
+            match_desc.get_ofs() + len(match_desc.get_token()))
+
+
+def _prescan_file(filename):
+    """Return True if the file needs the full (serial) spell check.
+
+    Unreadable files, and any file whose check raises (e.g. SystemExit
+    for a file outside --relative-to), are flagged too, so that the
+    serial pass reproduces and reports the error.
+
+    """
+    if _prescan_state is None:
+        # Initialization failed; let the serial pass report why.
+        return True
+    (dicts, c_escapes) = _prescan_state
+    try:
+        return not spell_check_file(filename, dicts, set(), _prescan_report,
+                                    c_escapes)
+    except BaseException:
+        # An escaping exception (SystemExit included) would kill the
+        # worker and leave pool.map blocked forever.
+        return True
+
+
+def _prescan(source_filenames, dict_file, base_dicts, relative_to,
+             additional_extensions, c_escapes):
+    """Find the files which need a full spell-check pass.
+
+    Scanning is embarrassingly parallel across files, so fan it out to a
+    pool of worker processes and return (in order) only the files which
+    contain something worth reporting or prompting about.  Dictionaries
+    and the session ignore list only ever gain entries during a run, so a
+    file found clean here would also be found clean by the serial pass.
+
+    """
+    try:
+        pool = multiprocessing.Pool(
+            initializer=_prescan_init,
+            initargs=(dict_file, base_dicts, relative_to,
+                      additional_extensions, c_escapes))
+    except OSError:
+        # Process creation is not available; check everything serially.
+        return source_filenames
+    try:
+        suspects = pool.map(_prescan_file, source_filenames)
+    finally:
+        pool.close()
+        pool.join()
+    return [f for (f, suspect) in zip(source_filenames, suspects) if suspect]
+
+
 def spell_check(source_filenames, override_dictionary=None,
                 base_dicts=[],
                 relative_to=None, report_only=False, c_escapes=True,
@@ -730,8 +915,16 @@ def spell_check(source_filenames, override_dictionary=None,
     with CorporaFile(dict_file, base_dicts, relative_to) as dicts:
         for extension in (additional_extensions or []):
             dicts.register_extension(*extension)
+        # The dictionary set parsed cleanly in this process, so it is now
+        # safe for prescan workers to load it again.
+        if len(source_filenames) > 1:
+            filenames = _prescan(source_filenames, dict_file, base_dicts,
+                                 relative_to, additional_extensions,
+                                 c_escapes)
+        else:
+            filenames = source_filenames
         ignores = set()
-        for f in source_filenames:
+        for f in filenames:
             if not spell_check_file(f, dicts, ignores, report_only, c_escapes):
                 okay = False
     return okay
@@ -48,6 +48,10 @@ MATCH_NATURAL = 0x1
 MATCH_FILETYPE = 0x2
 MATCH_FILEID = 0x4
 
+# Upper bound on the number of memoized match results kept per
+# PrefixMatchCorpus; the cache is cleared if it grows beyond this.
+MATCH_CACHE_MAX = 4096
+
 
 class ParsingError(Exception):
 
@@ -165,14 +169,26 @@ class PrefixMatchCorpus(Corpus):
         specified dictionary type and associated metadata."""
         Corpus.__init__(self, dict_type, metadata)
         self._tokens = sorted(tokens)
+        # Source code repeats a small set of hot identifiers over and over,
+        # so memoize match results; a hit costs one dict lookup instead of
+        # a bisection through the full word list.
+        self._match_cache = {}
 
     def match(self, token):
         """Return True if the token is a prefix of an item in this Corpus."""
+        try:
+            return self._match_cache[token]
+        except KeyError:
+            pass
         insertion_point = bisect_left(self._tokens, token)
         if insertion_point < len(self._tokens):
-            return self._tokens[insertion_point].startswith(token)
+            result = self._tokens[insertion_point].startswith(token)
         else:
-            return False
+            result = False
+        if len(self._match_cache) >= MATCH_CACHE_MAX:
+            self._match_cache.clear()
+        self._match_cache[token] = result
+        return result
 
     def add(self, token):
         """Add the specified token to this Corpus."""
@@ -180,6 +196,8 @@ class PrefixMatchCorpus(Corpus):
         if (insertion_point >= len(self._tokens) or
                 self._tokens[insertion_point] != token):
             self._tokens.insert(insertion_point, token)
+            # Negative match results may have become stale
+            self._match_cache.clear()
             self._mark_dirty()
 
     def write(self, f):
@@ -362,6 +380,7 @@ class CorporaFile(object):
             else:
                 new_tokens.append(t)
         self._natural_dict._tokens = new_tokens
+        self._natural_dict._match_cache.clear()
 
         for ext in self._extensions:
             # Generate a fake file name to use to query the base dicts.